@@ -9,18 +9,28 @@ class BlittedCursor:
     def __init__(self, ax, color='white'):
         self.ax = ax
         self.background = None
+        # animated artists are left out of full canvas draws
         self.horizontal_line = ax.plot(
-            [], [], color=color, lw=0.8, ls='-', alpha=0.5)[0]
+            [], [], color=color, lw=0.8, ls='-', alpha=0.5, animated=True)[0]
         self.vertical_line = ax.plot(
-            [], [], color=color, lw=0.8, ls='-', alpha=0.5)[0]
+            [], [], color=color, lw=0.8, ls='-', alpha=0.5, animated=True)[0]
 
         # text location in axes coordinates
-        self.text = ax.text(0.72, 0.9, '', transform=ax.transAxes)
-        self._creating_background = False
+        self.text = ax.text(0.72, 0.9, '', transform=ax.transAxes,
+                            animated=True)
+        self._cursor_state = None
+        self._d_per_pixel = None
+        self._last_xy_px = None
+        self._last_in = None
         ax.figure.canvas.mpl_connect('draw_event', self.on_draw)
+        ax.figure.canvas.mpl_connect('axes_enter_event', self.on_axes_enter)
 
     def on_draw(self, event):
-        self.create_new_background()
+        self.capture_background()
+
+    def on_axes_enter(self, event):
+        # toolbar may have changed the cursor while outside the axes
+        self._cursor_state = None
 
     def set_cross_hair_visible(self, visible):
         need_redraw = self.horizontal_line.get_visible() != visible
@@ -30,20 +40,49 @@ class BlittedCursor:
         return need_redraw
 
     def create_new_background(self):
-        if self._creating_background:
-            # discard calls triggered from within this function
-            return
-        self._creating_background = True
-        self.set_cross_hair_visible(False)
+        # draw_event handler captures the background
         self.ax.figure.canvas.draw()
+
+    def capture_background(self):
+        """Copy the current canvas contents under the axes.
+
+        Called after a full draw, or after other animated artists have
+        been blitted so that the crosshair restores them too.
+        """
         self.background = self.ax.figure.canvas.copy_from_bbox(self.ax.bbox)
-        self.set_cross_hair_visible(True)
-        self._creating_background = False
+        self._update_scale()
+        # force next mouse move to redraw over the new background
+        self._last_xy_px = None
+        # zoom/pan draws may have reset the cursor
+        self._cursor_state = None
+
+    def _update_scale(self):
+        # zoom invariant size, recomputed only on draw (zoom/resize)
+        x0, x1 = self.ax.get_xlim()
+        res = int(self.ax.figure.get_figwidth() * self.ax.figure.dpi)
+        self._d_per_pixel = (x1-x0) / res * 9
+
+    def _set_cursor(self, cursor):
+        if self._cursor_state == cursor:
+            return
+        self._cursor_state = cursor
+
+        if cursor == "none":
+            self.ax.figure.canvas._tkcanvas.configure(cursor="none")
+        else:
+            self.ax.figure.canvas.set_cursor(cursor)
 
     def on_mouse_move(self, event):
         if self.ax.figure.canvas.widgetlock.locked():
             return
 
+        # skip events that stay on the same pixel
+        xy_px = (int(event.x), int(event.y))
+        if xy_px == self._last_xy_px and event.inaxes == self._last_in:
+            return
+        self._last_xy_px = xy_px
+        self._last_in = event.inaxes
+
         if self.background is None:
             self.create_new_background()
 
@@ -52,16 +91,13 @@ class BlittedCursor:
             if need_redraw:
                 self.ax.figure.canvas.restore_region(self.background)
                 self.ax.figure.canvas.blit(self.ax.bbox)
-                self.ax.figure.canvas.set_cursor(Cursors.SELECT_REGION)
+                self._set_cursor(Cursors.SELECT_REGION)
         else:
             # hide cursor
-            self.ax.figure.canvas._tkcanvas.configure(cursor="none")
+            self._set_cursor("none")
             self.set_cross_hair_visible(True)
 
-            # zoom invariant size
-            x0, x1 = self.ax.get_xlim()
-            res = int(self.ax.figure.get_figwidth() * self.ax.figure.dpi)
-            d = (x1-x0) / res * 9
+            d = self._d_per_pixel
 
             # update the line positions
             x, y = event.xdata, event.ydata
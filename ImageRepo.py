@@ -1,10 +1,112 @@
 from pathlib import Path
 import csv
-from collections import defaultdict
-from typing import Dict, List, Optional, TypedDict
+import functools
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, TypedDict
 
 import cv2
 
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+logger = logging.getLogger(__name__)
+
+_CSV_BUFFER_SIZE = 1 << 20
+
+_EVENT_ORDER = {name: i for i, name in enumerate([
+    "rltd",
+    "bltd0",
+    "bltd",
+    "release",
+])}
+
+
+class ImageLRU:
+    """
+    Decoded images by path, evicting least recently used past max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str):
+        with self._lock:
+            arr = self._images.get(path)
+            if arr is not None:
+                self._images.move_to_end(path)
+            return arr
+
+    def put(self, path: str, arr):
+        with self._lock:
+            old = self._images.pop(path, None)
+            if old is not None:
+                self.total_bytes -= old.nbytes
+
+            self._images[path] = arr
+            self.total_bytes += arr.nbytes
+
+            # keep at least the newest image
+            while self.total_bytes > self.max_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.total_bytes = 0
+
+
+_image_cache = ImageLRU(
+    int(os.environ.get("VIDEO_LABELLER_CACHE_MB", 512)) * 1024 * 1024)
+
+
+def _decode(path: str):
+    arr = _image_cache.get(path)
+    if arr is None:
+        arr = cv2.imread(path)
+        if arr is not None:
+            _image_cache.put(path, arr)
+    return arr
+
+
+def clear_image_cache():
+    _image_cache.clear()
+
+
+class FramePrefetcher:
+    """
+    Decodes frame images in background threads to warm the image cache.
+    """
+
+    def __init__(self, max_workers=2):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def prefetch(self, path: str):
+        with self._lock:
+            if path in self._in_flight:
+                return
+            self._in_flight.add(path)
+
+        future = self._pool.submit(_decode, path)
+        future.add_done_callback(lambda _: self._done(path))
+
+    def _done(self, path: str):
+        with self._lock:
+            self._in_flight.discard(path)
+
+
 class MissingSubjectException (Exception):
     pass
 
@@ -12,54 +114,125 @@ class CsvFrame (TypedDict):
     input_file: str
     frame_file: str
     subject_id: str
-    throw_id: str
+    throw_id: int
     cam_id: str
     event_name: str
     rel_frame: int
     frame: int
+    _frame_path: str
 
 class Frame:
     rel_frame: int
     subject_id: str
-    trial_id: str
+    trial_id: int
     paths_by_cam: Dict[str, str]
     absolute_frame: int
 
-    def __init__(self, rel_frame, subject_id, trial_id, paths_by_cam, absolute_frame) -> None:
+    def __init__(self, rel_frame, subject_id, trial_id, paths_by_cam, absolute_frame,
+                 on_get_image: Optional[Callable[[], None]] = None) -> None:
         self.rel_frame = rel_frame
         self.subject_id = subject_id
         self.trial_id = trial_id
         self.paths_by_cam = paths_by_cam
         self.absolute_frame = absolute_frame
+        self._on_get_image = on_get_image
 
     def get_image(self, cam_id):
+        if self._on_get_image:
+            self._on_get_image()
+
         img_path = str(self.paths_by_cam[cam_id])
-        return cv2.imread(img_path)
+        return _decode(img_path)
 
     def get_path_by_cam(self, cam_id: str):
         return self.paths_by_cam.get(cam_id.lower())
 
-BySubjectFrameLookup = Dict[str, Dict[str, Dict[str, List[CsvFrame]]]]
+class EventFrames (TypedDict):
+    rows: List[CsvFrame]
+    by_cam: Dict[str, List[int]]
+
+BySubjectFrameLookup = Dict[str, Dict[str, Dict[str, EventFrames]]]
 
 class ImageRepo:
-    def __init__(self, csv_path: str):
+    def __init__(self, csv_path: str, prefetch: bool = True):
         self.csv_path = Path(csv_path)
-        self.by_subject = self._read_subject_lookup(self.csv_path)
+        self._prefetcher = FramePrefetcher() if prefetch else None
 
-    def _row_dict(self, head, row) -> CsvFrame:
-        d = dict(zip(head, row))
+    @functools.cached_property
+    def by_subject(self) -> BySubjectFrameLookup:
+        # parsed on first access
+        return self._partition_events(
+            self._read_subject_lookup(self.csv_path))
+
+    @functools.cached_property
+    def _by_key(self):
+        return self._build_key_index(self.by_subject)
+
+    @functools.cached_property
+    def _subjects_index(self) -> set:
+        if "by_subject" in self.__dict__:
+            return set(self.by_subject.keys())
+
+        # scan subject_id column only
+        if pd is None:
+            with self._open_csv(self.csv_path) as f:
+                return {row["subject_id"] for row in csv.DictReader(f, delimiter=";")}
+
+        df = pd.read_csv(self.csv_path,
+                         sep=";",
+                         usecols=["subject_id"],
+                         dtype={"subject_id": str},
+                         engine="c")
+        return set(df["subject_id"].unique())
+
+    def _open_csv(self, csv_path: Path):
+        # csv needs newline='', large buffer for fewer read syscalls
+        return csv_path.open("r", newline="", encoding="utf-8",
+                             buffering=_CSV_BUFFER_SIZE)
+
+    def _row_dict(self, d) -> CsvFrame:
+        # share one str object per category value
+        d["subject_id"] = sys.intern(d["subject_id"])
+        d["cam_id"] = sys.intern(d["cam_id"].lower())
+        d["event_name"] = sys.intern(d["event_name"])
+        d["throw_id"] = int(d["throw_id"])
         d["rel_frame"] = int(d["rel_frame"])
         d["frame"] = int(d["frame"])
         return d
 
     def _read_subject_lookup(self, csv_path) -> BySubjectFrameLookup:
-        reader = csv.reader(csv_path.open(), delimiter=";")
-        head = next(reader)
+        if pd is None:
+            return self._read_subject_lookup_csv(csv_path)
+
+        df = pd.read_csv(csv_path,
+                         sep=";",
+                         dtype={
+                             "subject_id": "category",
+                             "event_name": "category",
+                             "rel_frame": "int32",
+                             "frame": "int32",
+                             "throw_id": "int32",
+                         },
+                         engine="c")
+        df["cam_id"] = df["cam_id"].str.lower().astype("category")
 
+        # build lookup by {subject_id: {trial_id: {event_name: [...]}}}
+        lookup = defaultdict(
+            lambda: defaultdict(
+                lambda: defaultdict(
+                    list
+                )
+            )
+        )
+
+        for (sid, tid), trial in df.groupby(["subject_id", "throw_id"], sort=False, observed=True):
+            for event_name, frames in trial.groupby("event_name", sort=False, observed=True):
+                lookup[sid][int(tid)][event_name] = frames.to_dict("records")
+
+        return lookup
+
+    def _read_subject_lookup_csv(self, csv_path) -> BySubjectFrameLookup:
         # build lookup by {subject_id: {trial_id: [...]}}
-        subject_idx = head.index("subject_id")
-        trial_idx = head.index("throw_id")
-        event_idx = head.index("event_name")
         lookup = defaultdict(
             lambda: defaultdict(
                 lambda: defaultdict(
@@ -68,20 +241,51 @@ class ImageRepo:
             )
         )
 
-        for row in reader:
-            sid = row[subject_idx]
-            tid = int(row[trial_idx])
-            event_name = row[event_idx]
-            lookup[sid][tid][event_name].append(self._row_dict(head, row))
+        with self._open_csv(csv_path) as f:
+            for row in csv.DictReader(f, delimiter=";"):
+                row = self._row_dict(row)
+                lookup[row["subject_id"]][row["throw_id"]][row["event_name"]].append(row)
+
+        return lookup
+
+    def _partition_events(self, lookup) -> BySubjectFrameLookup:
+        # replace row lists with rows + sorted rel_frames by camera
+        frames_dir = str(self.csv_path.parent.joinpath("frames"))
+        for sid, trials in lookup.items():
+            for tid, events in trials.items():
+                for event_name, frames in events.items():
+                    by_cam = defaultdict(list)
+                    for frame in frames:
+                        # case-insensitive camera ids
+                        cam_id = frame["cam_id"].lower()
+                        frame["_frame_path"] = self._frame_path(
+                            frames_dir, sid, tid, cam_id, event_name,
+                            frame["rel_frame"])
+                        by_cam[frame["cam_id"]].append(frame["rel_frame"])
 
+                    events[event_name] = EventFrames(
+                        rows=frames,
+                        by_cam={cam_id: sorted(rel_frames)
+                                for cam_id, rel_frames in by_cam.items()})
         return lookup
 
+    def _build_key_index(self, lookup: BySubjectFrameLookup):
+        # index rows by (subject_id, trial_id, event_name, rel_frame)
+        by_key = {}
+        for sid, trials in lookup.items():
+            for tid, events in trials.items():
+                for event_name, bucket in events.items():
+                    for frame in bucket["rows"]:
+                        key = (sid, tid, event_name, frame["rel_frame"])
+                        by_key.setdefault(key, []).append(frame)
+        return by_key
+
     def get_cams(self) -> tuple:
         return ("oe", "ot")
 
     def get_subjects(self) -> list:
         # input_file;frame_file;subject_id;throw_id;cam_id;event_name;rel_frame;frame
-        return sorted(self.by_subject.keys())
+        return sorted(self._subjects_index)
 
     def get_trials(self, subject_id) -> list:
         return sorted(self.by_subject[subject_id].keys())
@@ -89,14 +293,8 @@ class ImageRepo:
     def _event_key(self, event):
         """Custom comparator function.
         """
-        order = [
-            "rltd",
-            "bltd0",
-            "bltd",
-            "release",
-        ]
-        # order by the list 'order' otherwise keep last
-        return order.index(event) if event in order else len(order)
+        # order by _EVENT_ORDER otherwise keep last
+        return _EVENT_ORDER.get(event, len(_EVENT_ORDER))
 
     def get_events(self, subject_id: str, trial_id: str) -> list:
         if subject_id not in self.by_subject:
@@ -106,18 +304,18 @@ class ImageRepo:
                       key=self._event_key)
 
     def get_all_frames(self, subject_id, trial_id):
-        for frames in self.by_subject[subject_id][trial_id].values():
-            for frame in frames:
+        for bucket in self.by_subject[subject_id][trial_id].values():
+            for frame in bucket["rows"]:
                 yield frame
 
-    def get_rel_frames(self, subject_id, trial_id, event_name, cam_id=None) -> List[Frame]:
-        frames = self.by_subject[subject_id][trial_id][event_name]
+    def get_rel_frames(self, subject_id, trial_id, event_name, cam_id=None) -> List[int]:
+        bucket = self.by_subject[subject_id][trial_id][event_name]
 
         # pick default cam_id
         if cam_id is None:
-            cam_id = frames[0]["cam_id"]
+            cam_id = bucket["rows"][0]["cam_id"]
 
-        return sorted([f["rel_frame"] for f in frames if f["cam_id"] == cam_id])
+        return bucket["by_cam"].get(cam_id, [])
 
     def get_frames(self, subject_id, trial_id) -> list:
         return self.by_subject[subject_id][trial_id]
@@ -130,30 +328,45 @@ class ImageRepo:
         else:
             return "0"
 
+    def _frame_path(self, frames_dir, subject_id, trial_id, cam_id, event_name, rel_frame) -> str:
+        rel_frame_str = self._format_rel_frame(rel_frame)
+        fname = f"{subject_id}_{trial_id}_{cam_id}_{event_name}_{rel_frame_str}.png"
+        return os.path.join(frames_dir, fname)
+
+    def _prefetch_neighbours(self, subject_id, trial_id, event_name, rel_frame):
+        for offset in (1, -1, 2, -2):
+            key = (subject_id, trial_id, event_name, rel_frame + offset)
+            for frame in self._by_key.get(key, ()):
+                self._prefetcher.prefetch(frame["_frame_path"])
+
+    def has_frame(self, subject_id, trial_id, event_name, rel_frame) -> bool:
+        return (subject_id, trial_id, event_name, rel_frame) in self._by_key
+
     def get_frame(self, subject_id, trial_id, event_name, rel_frame) -> Optional[Frame]:
         # find matching frame
-        match = tuple(filter(
-            lambda row: row["rel_frame"] == rel_frame,
-            self.by_subject[subject_id][trial_id][event_name]
-        ))
+        match = self._by_key.get((subject_id, trial_id, event_name, rel_frame))
 
         if not match:
             return
 
         paths_by_cam = {}
         for frame in match:
-            rel_frame_str = self._format_rel_frame(rel_frame)
-
             # case-insensitive camera ids
             cam_id = frame["cam_id"].lower()
-            fname = f"{subject_id}_{trial_id}_{cam_id}_{event_name}_{rel_frame_str}.png"
-            print("opening",fname)
-            path = self.csv_path.parent.joinpath("frames").joinpath(fname)
+            path = frame["_frame_path"]
+            logger.debug("opening %s", path)
             paths_by_cam[cam_id] = path
 
+        # warm image cache for adjacent frames when an image is read
+        prefetch = None
+        if self._prefetcher:
+            prefetch = functools.partial(self._prefetch_neighbours,
+                                         subject_id, trial_id, event_name, rel_frame)
+
         # build path
         return Frame(int(frame["rel_frame"]),
                      frame["subject_id"],
                      frame["throw_id"],
                      paths_by_cam,
-                     frame["frame"])
+                     frame["frame"],
+                     prefetch)
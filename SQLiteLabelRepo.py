@@ -1,7 +1,13 @@
 from pathlib import Path
+import contextlib
 import sqlite3
 from typing import TypedDict, List
 
+query_create_lookup_index = """
+CREATE INDEX IF NOT EXISTS idx_markers_lookup
+    ON markers (subject_id, trial_id, relative_frame);
+"""
+
 schema = """
 CREATE TABLE landmarks (
     name TEXT PRIMARY KEY
@@ -50,11 +56,19 @@ CREATE TABLE markers (
     FOREIGN KEY(cam_id) REFERENCES cameras(id),
     UNIQUE (subject_id, trial_id, event, relative_frame, cam_id, landmark)
 );
-"""
+""" + query_create_lookup_index
 
 query_select_frame = """
 SELECT
-    *
+    id,
+    subject_id,
+    trial_id,
+    event,
+    relative_frame,
+    cam_id,
+    landmark,
+    x,
+    y
 FROM
     markers
 WHERE
@@ -63,6 +77,24 @@ WHERE
     relative_frame = ?;
 """
 
+query_select_trial = """
+SELECT
+    id,
+    subject_id,
+    trial_id,
+    event,
+    relative_frame,
+    cam_id,
+    landmark,
+    x,
+    y
+FROM
+    markers
+WHERE
+    subject_id = ? AND
+    trial_id = ?;
+"""
+
 query_insert_landmark = """
 INSERT INTO markers (
     subject_id,
@@ -103,30 +135,32 @@ class Marker (TypedDict):
     y: float
 
 
-def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
-
-
 class SQLiteLabelRepo:
     def __init__(self, dbfile):
         dbpath = Path(dbfile)
 
+        # cursors by SQL string
+        self._stmt_cache = {}
+
         if not dbpath.is_file():
             self.conn = self.init_sqlite_db(dbpath)
         else:
             self.conn = self._connect(dbpath)
+            self._migrate()
 
     def __del__(self):
         if hasattr(self, "conn"):
             self.conn.close()
 
     def _connect(self, dbpath):
-        conn = sqlite3.connect(
-            str(dbpath), detect_types=sqlite3.PARSE_COLNAMES)
-        conn.row_factory = dict_factory
+        conn = sqlite3.connect(str(dbpath), cached_statements=256)
+        conn.row_factory = sqlite3.Row
+
+        # WAL avoids an fsync per committed marker
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        conn.execute("PRAGMA cache_size=-65536;")
         return conn
 
     def init_sqlite_db(self, dbpath):
@@ -137,6 +171,19 @@ class SQLiteLabelRepo:
 
         return conn
 
+    def _exec(self, sql, params=()):
+        cur = self._stmt_cache.get(sql)
+        if cur is None:
+            cur = self._stmt_cache[sql] = self.conn.cursor()
+        return cur.execute(sql, params)
+
+    def _fetchall(self, sql, params=()):
+        return self._exec(sql, params).fetchall()
+
+    def _migrate(self):
+        with self.conn:
+            self.conn.execute(query_create_lookup_index)
+
     def _landmark_cmp(self, lm: str) -> int:
         """Custom comparator function.
         """
@@ -155,32 +202,51 @@ class SQLiteLabelRepo:
         return order.index(lm) if lm in order else len(order)
 
     def get_available_landmarks(self) -> List[str]:
-        cur = self.conn.cursor()
-        res = cur.execute(query_select_landmarks)
-        xs = [row["name"] for row in res.fetchall()]
+        xs = [row["name"] for row in self._fetchall(query_select_landmarks)]
         return sorted(xs, key=self._landmark_cmp)        
 
     def get_frame(self, subject_id: str, trial_id: int, relative_frame: int) -> List[Marker]:
-        cur = self.conn.cursor()
         params = (
             subject_id,
             trial_id,
             relative_frame,
         )
-        res = cur.execute(query_select_frame, params)
-        return res.fetchall()
+        return self._fetchall(query_select_frame, params)
 
-    def update_point(self, point_id, x, y):
-        with self.conn:
+    def get_trial_markers(self, subject_id: str, trial_id: int) -> List[Marker]:
+        return self._fetchall(query_select_trial, (subject_id, trial_id))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run the enclosed writes in one transaction.
+
+        Nested use joins the outer transaction.
+        """
+        if self.conn.in_transaction:
+            yield self
+            return
+
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+        except BaseException:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+
+    def update_point(self, point_id, x, y) -> int:
+        with self.transaction():
             params = (
                 x,
                 y,
                 point_id,
             )
-            self.conn.execute(query_update_landmark, params)
+            self._exec(query_update_landmark, params)
+        return point_id
 
-    def create_point(self, subject_id, trial_id, event_name, relative_frame, cam_id, landmark, x, y):
-        with self.conn:
+    def create_point(self, subject_id, trial_id, event_name, relative_frame, cam_id, landmark, x, y) -> int:
+        with self.transaction():
             params = (
                 subject_id,
                 trial_id,
@@ -191,7 +257,16 @@ class SQLiteLabelRepo:
                 x,
                 y,
             )
-            self.conn.execute(query_insert_landmark, params)
+            return self._exec(query_insert_landmark, params).lastrowid
+
+    def create_points(self, rows):
+        """Insert many markers in a single transaction.
+
+        Rows are tuples of (subject_id, trial_id, event_name,
+        relative_frame, cam_id, landmark, x, y).
+        """
+        with self.transaction():
+            self.conn.executemany(query_insert_landmark, rows)
 
 
 if __name__ == "__main__":
@@ -204,4 +279,4 @@ if __name__ == "__main__":
         point = points[0]
         r.update_point(point["id"], 823.4, 232)
 
-    print(r.get_frame("S101", 1, -8))
+    print([dict(row) for row in r.get_frame("S101", 1, -8)])
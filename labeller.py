@@ -1,16 +1,28 @@
-from collections import defaultdict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
 import pprint
 import sys
+import threading
 import argparse
-from typing import Dict, List, Optional, TypedDict
+from typing import Dict, List, NamedTuple, Optional
 from matplotlib.lines import Line2D
 import matplotlib.pyplot as plt
 import json
+import numpy as np
+from PIL import Image
+
+try:
+    from turbojpeg import TJPF_RGB, TurboJPEG
+except ImportError:
+    TurboJPEG = None
+
 from BlittedCursor import BlittedCursor
 
 from ImageRepo import ImageRepo
 from SQLiteLabelRepo import Marker, SQLiteLabelRepo
 
+logger = logging.getLogger(__name__)
 
 def scale(ax, scale, center_x, center_y, ref_height=1080):
     dx = (ref_height / 2) / scale
@@ -18,7 +30,57 @@ def scale(ax, scale, center_x, center_y, ref_height=1080):
     ax.set_xlim(center_x - dx, center_x + dx)
 
 
-class FrameLookupEntry (TypedDict):
+_thread_local = threading.local()
+
+
+def _turbojpeg():
+    # one decoder instance per worker thread
+    if not hasattr(_thread_local, "turbojpeg"):
+        _thread_local.turbojpeg = TurboJPEG()
+    return _thread_local.turbojpeg
+
+
+def _reduce_factor(width, max_width):
+    # power of two (up to 8) keeping the image at least max_width wide
+    factor = 1
+    while max_width and factor < 8 and width >= 2 * factor * max_width:
+        factor *= 2
+    return factor
+
+
+def read_image(path, max_width=None):
+    """Decode RGB image, downsampled by a power of two if wider than
+    2 * max_width. Returns (image, factor).
+    """
+    if TurboJPEG is not None and path.lower().endswith((".jpg", ".jpeg")):
+        decoder = _turbojpeg()
+        with open(path, "rb") as f:
+            data = f.read()
+
+        # libjpeg-turbo scales while decoding
+        width, *_ = decoder.decode_header(data)
+        factor = _reduce_factor(width, max_width)
+        image = decoder.decode(data,
+                               pixel_format=TJPF_RGB,
+                               scaling_factor=(1, factor))
+    else:
+        # PIL releases the GIL while decoding
+        with Image.open(path) as img:
+            factor = _reduce_factor(img.width, max_width)
+
+            # convert() copies the frame even when already RGB
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            if factor > 1:
+                img = img.reduce(factor)
+            image = np.asarray(img)
+
+    # decoded images are shared through the image cache
+    image.setflags(write=False)
+    return image, factor
+
+
+class FrameLookupEntry (NamedTuple):
     event: str
     cam_id: str
     rel_frame: int
@@ -27,42 +89,30 @@ class FrameLookupEntry (TypedDict):
 
 class FrameLookup:
     def __init__(self, subject_id: str, trial_id: str, image_repo: ImageRepo) -> None:
-        self.lookup = self._build_lookup(image_repo,
-                                         subject_id,
-                                         trial_id)
-        self.reverse_lookup = self._build_lookup_relframe(image_repo,
-                                                          subject_id,
-                                                          trial_id)
-
-    def _build_lookup(self, repo: ImageRepo, subject_id, trial_id):
-        lookup = defaultdict(list)
-        for frame in repo.get_all_frames(subject_id, trial_id):
-            abs_frame = frame["frame"]
-            rel_frame = frame["rel_frame"]
-            event = frame["event_name"]
-            cam_id = frame["cam_id"]
-            lookup[abs_frame].append(FrameLookupEntry(event=event,
-                                                      cam_id=cam_id,
-                                                      rel_frame=rel_frame,
-                                                      abs_frame=abs_frame))
-        return lookup
+        self.lookup, self.reverse_lookup = self._build(image_repo,
+                                                       subject_id,
+                                                       trial_id)
 
-    def _build_lookup_relframe(self, repo: ImageRepo, subject_id, trial_id):
-        lookup = defaultdict(lambda: defaultdict(int))
+    def _build(self, repo: ImageRepo, subject_id, trial_id):
+        # entries by absolute frame, absolute frames by (rel_frame, event)
+        by_abs = {}
+        by_rel = {}
 
         for frame in repo.get_all_frames(subject_id, trial_id):
             abs_frame = frame["frame"]
             rel_frame = frame["rel_frame"]
             event = frame["event_name"]
-            lookup[rel_frame][event] = abs_frame
+            by_abs.setdefault(abs_frame, []).append(
+                FrameLookupEntry(event, frame["cam_id"], rel_frame, abs_frame))
+            by_rel[(rel_frame, event)] = abs_frame
 
-        return lookup
+        return by_abs, by_rel
 
     def by_frame(self, frame: int) -> List[FrameLookupEntry]:
         return self.lookup.get(frame, [])
 
     def by_relframe(self, event: str, rel_frame: int) -> int:
-        return self.reverse_lookup[rel_frame].get(event, None)
+        return self.reverse_lookup.get((rel_frame, event))
 
 class BitmapStore:
     def __init__(self, repo: ImageRepo):
@@ -74,6 +124,8 @@ class LabellerApp:
     landmark_color_current = "y"
     landmark_color = "purple"
     landmark_color_sibling = "gray"
+    image_cache_size = 64
+    image_max_width = 1920
 
     def __init__(self,
                  image_repo: ImageRepo,
@@ -92,6 +144,22 @@ class LabellerApp:
 
         # event names
         self.event_names = image_repo.get_events(subject_id, trial_id)
+        self._rel_frames_by_event = {
+            e: image_repo.get_rel_frames(subject_id, trial_id, e)
+            for e in self.event_names
+        }
+
+        # (i_event, i_frame) positions with frame images, in labelling order
+        self._valid_positions = [
+            (i_event, i_frame)
+            for i_event, event_name in enumerate(self.event_names)
+            for i_frame, rel_frame in enumerate(self._rel_frames_by_event[event_name])
+            if image_repo.has_frame(subject_id, trial_id, event_name, rel_frame)
+        ]
+        self._pos_index = {pos: i for i, pos in enumerate(self._valid_positions)}
+        self._n_positions = len(self._valid_positions)
+        self._n_kps = len(self.avail_landmarks)
+        self._n_events = len(self.event_names)
 
         # setup subpolots
         self.fig, ax = plt.subplots(1, 2)
@@ -100,6 +168,10 @@ class LabellerApp:
         self.axes = [self.ax1, self.ax2]
         plt.subplots_adjust(wspace=0, hspace=0, left=0, right=1)
 
+        if not self.fig.canvas.supports_blit:
+            logger.warning("backend %s does not support blitting",
+                           plt.get_backend())
+
         # crosshair
         self.cursor1 = BlittedCursor(self.ax1)
 
@@ -108,9 +180,28 @@ class LabellerApp:
         self.fig.canvas.mpl_connect('motion_notify_event',
                                     self.cursor1.on_mouse_move
                                     )
+        self.fig.canvas.mpl_connect('draw_event', self.on_draw)
+        self._background = None
 
         self.im1 = None
         self.im2 = None
+        self._last_paths = None
+
+        # decoded images by path, as futures of the decode pool
+        self._pool = ThreadPoolExecutor(max_workers=4)
+        self._img_cache = OrderedDict()
+
+        # image paths by (i_event, i_frame, i_cam)
+        self._image_paths = {}
+
+        # (state, image futures) of a frame still decoding on the pool
+        self._pending = None
+        # clicks made while it decodes, and any keys after them, replayed
+        # in order once the frame is shown
+        self._queued_input = []
+        self._fetch_timer = self.fig.canvas.new_timer(interval=10)
+        self._fetch_timer.single_shot = True
+        self._fetch_timer.add_callback(self._poll_fetch)
 
         # init state
         self.i_kp = 0
@@ -118,27 +209,49 @@ class LabellerApp:
         self.i_frame = 0
         self.i_cam = 0
         self.cam_ids = cam_ids
-        self.markers = None
+        self._n_cams = len(cam_ids)
+
+        # camera order per selected camera, selected first
+        self._cam_orders = [
+            tuple([selected] + [i for i in cam_ids if i != selected])
+            for selected in cam_ids
+        ]
+        self._markers_by_rel = {}
 
         # bootstrap render
         self.load_markers()
-        self.title = self.fig.suptitle(self._get_title())
+        self.title = self.fig.suptitle(self._get_title(), animated=True)
         self.landmark_artists = self._draw_initial_landmark_object()
         _cam_ids = self._current_cam_ids()
         self.ax1.set_xlabel(f"cam: {_cam_ids[0]}")
         self.ax2.set_xlabel(f"cam: {_cam_ids[1]}")
         self.load_image(*self._get_image_paths())
+        self._prefetch_neighbors()
         print(" * Ready!")
 
     def load_markers(self):
-        print("Current relative frame:", self._current_rel_frame())
-        self.markers = self.repo.get_frame(self.subject_id,
-                                           self.trial_id,
-                                           self._current_rel_frame()
-                                           )
+        # all markers of the trial, navigation reads them from memory
+        markers = self.repo.get_trial_markers(self.subject_id, self.trial_id)
+
+        self._markers_by_rel = {}
+        for marker in markers:
+            self._store_marker(marker)
+
+        logger.debug("loaded %i markers", len(markers))
+
+    def _store_marker(self, marker: Marker):
+        # index by {rel_frame: {(cam_id, event): {landmark: marker}}}
+        frame = self._markers_by_rel.setdefault(marker["relative_frame"], {})
+        key = (marker["cam_id"], marker["event"])
+        frame.setdefault(key, {})[marker["landmark"]] = marker
+
+    def _markers_at(self, rel_frame, cam_id, event) -> Dict[str, Marker]:
+        return self._markers_by_rel.get(rel_frame, {}).get((cam_id, event), {})
 
     def _get_title(self):
-        return f"{self.avail_landmarks[self.i_kp]} ({self.subject_id}/{self.trial_id}, {self._current_event_name()}, frame={self._current_rel_frame()})"
+        event = self._current_event_name()
+        rel_frame = self._rel_frames_by_event[event][self.i_frame]
+        return f"{self.avail_landmarks[self.i_kp]} ({self.subject_id}/{self.trial_id}, {event}, frame={rel_frame})"
 
     def _current_event_name(self):
         if self.i_event < 0 or self.i_event >= len(self.event_names):
@@ -150,11 +263,7 @@ class LabellerApp:
         return self.avail_landmarks[self.i_kp]
 
     def _rel_frames(self):
-        return image_repo.get_rel_frames(
-            self.subject_id,
-            self.trial_id,
-            self._current_event_name()
-        )
+        return self._rel_frames_by_event[self._current_event_name()]
 
     def _current_rel_frame(self):
         return self._rel_frames()[self.i_frame]
@@ -162,48 +271,71 @@ class LabellerApp:
     def _current_cam_id(self):
         return self.cam_ids[self.i_cam]
 
+    def _cam_ids_at(self, i_cam):
+        return self._cam_orders[i_cam]
+
     def _current_cam_ids(self):
-        selected = self._current_cam_id()
-        rest = [i for i in self.cam_ids if i != selected]
-        return [selected] + rest
+        return self._cam_ids_at(self.i_cam)
+
+    def _image_paths_at(self, i_event, i_frame, i_cam):
+        key = (i_event, i_frame, i_cam)
+        if key in self._image_paths:
+            return self._image_paths[key]
+
+        event_name = self.event_names[i_event]
+        rel_frames = self._rel_frames_by_event[event_name]
+        frame = self.image_repo.get_frame(self.subject_id, self.trial_id,
+                                          event_name,
+                                          rel_frames[i_frame]
+                                          )
+        paths = None
+        if frame:
+            paths = tuple(frame.paths_by_cam[cam_id] for cam_id in self._cam_ids_at(i_cam))
+
+        self._image_paths[key] = paths
+        return paths
 
     def _get_image_paths(self):
-        frame = image_repo.get_frame(self.subject_id, self.trial_id,
-                                     self._current_event_name(),
-                                     self._current_rel_frame()
-                                     )
-        cam_ids = self._current_cam_ids()
-        return [frame.paths_by_cam[cam_id] for cam_id in cam_ids]
+        return self._image_paths_at(self.i_event, self.i_frame, self.i_cam)
 
     def get_fig(self):
         return self.fig
 
     def onkeypress(self, event):
         if self.is_drawing:
-            print("Busy ...")
+            logger.debug("busy, key ignored")
             return
 
+        # keep order with clicks waiting for the frame
+        if self._queued_input:
+            logger.debug("frame loading, key queued")
+            self._queued_input.append(("key", event.key))
+            return
+
+        self._handle_key(event.key)
+
+    def _handle_key(self, key):
         # keypoint change
-        if event.key == 'a':
-            self.i_kp = (self.i_kp - 1) % len(self.avail_landmarks)
-            print(" * Previous keypoint")
-        elif event.key == 'd':
-            self.i_kp = (self.i_kp + 1) % len(self.avail_landmarks)
-            print(" * Next keypoint")
-        elif event.key == 'z':
-            self.i_event = (self.i_event - 1) % len(self.event_names)
-            print(" * Previous event (%i)" % self.i_event)
-        elif event.key == 'c':
-            self.i_event = (self.i_event + 1) % len(self.event_names)
-            print(" * Next event (%i)" % self.i_event)
-        elif event.key == '/':
-            self.i_cam = (self.i_cam - 1) % len(self.cam_ids)
-        elif event.key == '*':
-            self.i_cam = (self.i_cam + 1) % len(self.cam_ids)
-        elif event.key == "+":
+        if key == 'a':
+            self.i_kp = (self.i_kp - 1) % self._n_kps
+            logger.debug("previous keypoint")
+        elif key == 'd':
+            self.i_kp = (self.i_kp + 1) % self._n_kps
+            logger.debug("next keypoint")
+        elif key == 'z':
+            self.i_event = (self.i_event - 1) % self._n_events
+            logger.debug("previous event (%i)", self.i_event)
+        elif key == 'c':
+            self.i_event = (self.i_event + 1) % self._n_events
+            logger.debug("next event (%i)", self.i_event)
+        elif key == '/':
+            self.i_cam = (self.i_cam - 1) % self._n_cams
+        elif key == '*':
+            self.i_cam = (self.i_cam + 1) % self._n_cams
+        elif key == "+":
             n_relframes = len(self._rel_frames())
             self.i_frame = (self.i_frame + 1) % n_relframes
-        elif event.key == "-":
+        elif key == "-":
             n_relframes = len(self._rel_frames())
             self.i_frame = (self.i_frame - 1) % n_relframes
         else:
@@ -211,10 +343,66 @@ class LabellerApp:
 
         self.is_drawing = True
 
-        self.load_markers()
-        self._draw_frame()
+        # keypoint change keeps the same images and markers
+        if key in {'a', 'd'} and self._pending is None:
+            self._draw_markers_only()
+        else:
+            self._request_state()
+
         self.is_drawing = False
 
+    def _state(self):
+        return (self.i_kp, self.i_event, self.i_frame, self.i_cam)
+
+    def _request_state(self):
+        # decode off the GUI thread, _poll_fetch draws when done
+        futures = [self._get_or_submit(path) for path in self._get_image_paths()]
+        self._pending = (self._state(), futures)
+        self._fetch_timer.start()
+
+    def _poll_fetch(self):
+        if self._pending is None:
+            return
+
+        _, futures = self._pending
+        if not all(future.done() for future in futures):
+            self._fetch_timer.start()
+            return
+
+        self._finish_fetch()
+
+    def _finish_fetch(self):
+        # load_image blocks until the latest request has decoded
+        state, _ = self._pending
+        self._pending = None
+
+        if state != self._state():
+            self._request_state()
+            return
+
+        self.is_drawing = True
+        try:
+            self._draw_frame()
+        except Exception:
+            # keep the app running, the next visit reads the images again
+            logger.exception("failed to show frame %s", self._get_image_paths())
+            if self._queued_input:
+                logger.warning("dropped %i inputs queued for the frame",
+                               len(self._queued_input))
+                self._queued_input.clear()
+            return
+        finally:
+            self.is_drawing = False
+
+        # replay in arrival order, as a blocking redraw would have; a
+        # placed marker or a frame change may start the next load
+        while self._queued_input and self._pending is None:
+            kind, *args = self._queued_input.pop(0)
+            if kind == "key":
+                self._handle_key(*args)
+            else:
+                self._set_marker(*args)
+
     def _draw_initial_object(self, obj: Optional[Marker],
                              color,
                              linewidth=1.0,
@@ -227,9 +415,9 @@ class LabellerApp:
         }
 
         if obj:
-            return self.ax1.plot([obj["x"]], [obj["y"]], '+', **style)[0]
+            return self.ax1.plot([obj["x"]], [obj["y"]], '+', animated=True, **style)[0]
         else:
-            return self.ax1.plot([0, 0], '+', **style)[0]
+            return self.ax1.plot([], [], '+', animated=True, **style)[0]
 
     def _draw_initial_landmark_object(self) -> Dict[str, Line2D]:
         curr_lm = self._current_landmark()
@@ -257,12 +445,38 @@ class LabellerApp:
         return artists
 
     def _draw_frame(self):
+        paths = self._get_image_paths()
+        if paths == self._last_paths:
+            self._draw_markers_only()
+            return
+
+        # render
+        self.load_image(*paths)
+        self._update_landmark_artists()
+
+        # labels
+        _cam_ids = self._current_cam_ids()
+        self.ax1.set_xlabel(f"cam: {_cam_ids[0]}")
+        self.ax2.set_xlabel(f"cam: {_cam_ids[1]}")
+
+        # redraw images when idle, coalescing fast key repeats; animated
+        # artists are blitted in on_draw
+        self.fig.canvas.draw_idle()
+
+        self._prefetch_neighbors()
+
+    def _draw_markers_only(self):
+        # same images, only markers and title change
+        self._update_landmark_artists()
+        self._blit_artists()
+
+    def _update_landmark_artists(self):
         current_lm = self._current_landmark()
+        color_current = self.landmark_color_current
+        color = self.landmark_color
         frame_lms = self._current_frame_objects()
         sibling_lms = self._sibling_frame_objects()
 
-        # render
-        self.load_image(*self._get_image_paths())
         self.title.set_text(self._get_title())
 
         for artist in self.landmark_artists.values():
@@ -275,42 +489,49 @@ class LabellerApp:
             if not artist:
                 continue
 
-            artist.set_data([obj["x"], obj["y"]])
+            artist.set_data((obj["x"],), (obj["y"],))
             artist.set_visible(True)
 
             # is selected landmark?
             if lm == current_lm:
-                print("current frame_lm", lm)
-                artist.set_color(self.landmark_color_current)
+                logger.debug("current frame_lm %s", lm)
+                artist.set_color(color_current)
             else:
-                artist.set_color(self.landmark_color)
+                artist.set_color(color)
 
         # render sibling frame (prev and next) markers
         for lm, obj in sibling_lms.items():
             artist = self.landmark_artists.get(lm)
-            print("sibling lm", lm, obj["x"], obj["y"], obj["subject_id"],
-                  obj["event"], obj["relative_frame"], obj["cam_id"])
+            logger.debug("sibling lm %s %s %s %s %s %s %s", lm, obj["x"], obj["y"],
+                         obj["subject_id"], obj["event"], obj["relative_frame"],
+                         obj["cam_id"])
 
             if not artist:
                 continue
 
-            artist.set_data([obj["x"], obj["y"]])
+            artist.set_data((obj["x"],), (obj["y"],))
             artist.set_visible(True)
 
-        # labels
-        _cam_ids = self._current_cam_ids()
-        self.ax1.set_xlabel(f"cam: {_cam_ids[0]}")
-        self.ax2.set_xlabel(f"cam: {_cam_ids[1]}")
+    def on_draw(self, event):
+        # background without animated artists
+        self._background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self._blit_artists()
 
-        # update canvas
-        self.fig.canvas.flush_events()
-        for artist in self.landmark_artists.values():
-            self.fig.draw_artist(artist)
+    def _blit_artists(self):
+        if self._background is None:
+            # first draw captures the background and blits
+            self.fig.canvas.draw()
+            return
 
+        canvas = self.fig.canvas
+        canvas.restore_region(self._background)
+        for artist in self.landmark_artists.values():
+            self.ax1.draw_artist(artist)
         self.fig.draw_artist(self.title)
-        self.fig.draw_artist(self.im1)
-        self.fig.draw_artist(self.im2)
-        plt.show()
+        canvas.blit(self.fig.bbox)
+
+        # crosshair restores markers from its own background
+        self.cursor1.capture_background()
 
     def _which_ax(self, event):
         for i, ax in enumerate(self.axes):
@@ -326,31 +547,21 @@ class LabellerApp:
 
         pane = self._which_ax(event)
         if event.button == 1 and pane == 0:
-            self._set_marker(event.xdata, event.ydata)
+            # shown image is not the current frame yet
+            if self._pending is not None:
+                logger.debug("frame loading, click queued")
+                self._queued_input.append(("click", event.xdata, event.ydata))
+                return
 
-    def match_landmark(self, other):
-        current_landmark = self.avail_landmarks[self.i_kp]
-
-        cs = [
-            other["landmark"] == current_landmark,
-            other["cam_id"] == self._current_cam_id(),
-            other["event"] == self._current_event_name(),
-        ]
-        return all(cs)
-
-    def match_frame(self, other):
-        cs = [
-            other["cam_id"] == self._current_cam_id(),
-            other["event"] == self._current_event_name(),
-        ]
-        return all(cs)
+            self._set_marker(event.xdata, event.ydata)
 
     def _current_landmark_object(self) -> Marker:
-        matched = list(filter(self.match_landmark, self.markers))
-        return matched[0] if matched else None
+        return self._current_frame_objects().get(self._current_landmark())
 
     def _current_frame_objects(self) -> Dict[str, Marker]:
-        return dict((obj["landmark"], obj) for obj in self.markers if self.match_frame(obj))
+        return self._markers_at(self._current_rel_frame(),
+                                self._current_cam_id(),
+                                self._current_event_name())
 
     def _sibling_frame_objects(self) -> Dict[str, Marker]:
         # find abs frame
@@ -360,16 +571,14 @@ class LabellerApp:
         landmark = self._current_landmark()
         abs_frame = self.sibling_lookup.by_relframe(event, curr_rel_frame)
 
-        # find siblings
-        objs = {}
+        # find sibling frames
+        candidates = []
 
         found = {
             "prev": False,
             "next": False
         }
 
-        has_next = False
-
         for prefix, sibling_frame in [("prev", -1), ("next", 1), ("prev", -2), ("next", 2)]:
             # find by absolute frame
             entries = self.sibling_lookup.by_frame(abs_frame + sibling_frame)
@@ -383,28 +592,17 @@ class LabellerApp:
             found[prefix] = True
 
             for entry in entries:
-#                print(" - current %i, entry frame %i, entry_rel: %s" % (abs_frame, entry["abs_frame"], entry["rel_frame"]))
-
-                # get frame markers
-                markers = self.repo.get_frame(
-                    self.subject_id,
-                    self.trial_id,
-                    entry["rel_frame"]
-                )
-
-                # add to lookup
-                for marker in markers:
-                    if marker["cam_id"] != cam_id:
-                        continue
+                candidates.append((prefix, entry))
 
-                    if marker["landmark"] != landmark:
-                        continue
+        if not candidates:
+            return {}
 
-                    if marker["event"] != entry["event"]:
-                        continue
-
-                    key = f"{prefix}-{marker['landmark']}"
-                    objs[key] = marker
+        # add to lookup
+        objs = {}
+        for prefix, entry in candidates:
+            marker = self._markers_at(entry.rel_frame, cam_id, entry.event).get(landmark)
+            if marker:
+                objs[f"{prefix}-{landmark}"] = marker
 
         return objs
 
@@ -414,134 +612,137 @@ class LabellerApp:
 
         if landmark:
             # update
-            print("   - Label (%s): subject='%s', trial=%i, event=%s, frame=%i, cam=%s, point=(%.2f, %.2f) update(id=%i)" % (
-                landmark["landmark"],
-                landmark["subject_id"],
-                landmark["trial_id"],
-                landmark["event"],
-                landmark["relative_frame"],
-                landmark["cam_id"],
-                x, y,
-                landmark["id"])
-            )
+            logger.info("label (%s): subject='%s', trial=%i, event=%s, frame=%i, cam=%s, point=(%.2f, %.2f) update(id=%i)",
+                        landmark["landmark"],
+                        landmark["subject_id"],
+                        landmark["trial_id"],
+                        landmark["event"],
+                        landmark["relative_frame"],
+                        landmark["cam_id"],
+                        x, y,
+                        landmark["id"])
             self.repo.update_point(landmark["id"], x, y)
+
+            self._store_marker(Marker(dict(landmark), x=x, y=y))
         else:
             # insert
-            print("   - Label (%s): subject='%s', trial=%i, event=%s, frame=%i, cam=%s, point=(%.2f, %.2f)" % (
-                self._current_landmark(),
-                self.subject_id,
-                self.trial_id,
-                self._current_event_name(),
-                self._current_rel_frame(),
-                self._current_cam_id(),
-                x, y)
-            )
-
-            self.repo.create_point(self.subject_id,
-                                   self.trial_id,
-                                   self._current_event_name(),
-                                   self._current_rel_frame(),
-                                   self._current_cam_id(),
-                                   self._current_landmark(),
-                                   x, y
-                                   )
+            marker = Marker(id=None,
+                            subject_id=self.subject_id,
+                            trial_id=self.trial_id,
+                            event=self._current_event_name(),
+                            relative_frame=self._current_rel_frame(),
+                            cam_id=self._current_cam_id(),
+                            landmark=self._current_landmark(),
+                            x=x,
+                            y=y)
+            logger.info("label (%s): subject='%s', trial=%i, event=%s, frame=%i, cam=%s, point=(%.2f, %.2f)",
+                        marker["landmark"],
+                        marker["subject_id"],
+                        marker["trial_id"],
+                        marker["event"],
+                        marker["relative_frame"],
+                        marker["cam_id"],
+                        x, y)
+
+            marker["id"] = self.repo.create_point(marker["subject_id"],
+                                                  marker["trial_id"],
+                                                  marker["event"],
+                                                  marker["relative_frame"],
+                                                  marker["cam_id"],
+                                                  marker["landmark"],
+                                                  x, y
+                                                  )
+
+            self._store_marker(marker)
 
         # progress frame
+        paths = self._get_image_paths()
         self.next_point()
 
-        # maintain strict consistency
-        self.load_markers()
+        # update view, images decode off the GUI thread
+        if self._get_image_paths() == paths:
+            self._draw_markers_only()
+        else:
+            self._request_state()
 
-        # update view
-        self._draw_frame()
+    def _next_position(self):
+        # step (event, frame) in labelling order, carry into keypoint, then camera
+        i_pos = self._pos_index.get((self.i_event, self.i_frame), -1) + 1
+        carry, i_pos = divmod(i_pos, self._n_positions)
+        i_event, i_frame = self._valid_positions[i_pos]
 
-    def _probe_frame(self):
-        # 1) progress frame
-        n_frames = len(self._rel_frames())
-        i_frame = (self.i_frame + 1) % n_frames
-        if i_frame > 0:
-            print(".")
-            return (i_frame, self.i_event, self.i_kp, self.i_cam)
-
-        # 2) progress event
-        n_events = len(self.event_names)
-        i_event = (self.i_event + 1) % n_events
-        if i_event > 0:
-            print("..")
-            return (i_frame, i_event, self.i_kp, self.i_cam)
-
-        # 3) progress keypoint
-        n_kps = len(self.avail_landmarks)
-        i_kp = (self.i_kp + 1) % n_kps
-        if i_kp > 0:
-            print("...")
-            return (i_frame, i_event, i_kp, self.i_cam)
-
-        # 4) progress camera
-        i_cam = (self.i_cam + 1) % len(self.cam_ids)
+        carry, i_kp = divmod(self.i_kp + carry, self._n_kps)
+        i_cam = (self.i_cam + carry) % self._n_cams
         return (i_frame, i_event, i_kp, i_cam)
 
-    def has_frame(self, subject_id: str, trial_id: str, i_event: str, i_frame: int):
-        # check if exists in image repo
-        event_name = self.event_names[i_event]
-        rel_frames = self.image_repo.get_rel_frames(
-            subject_id,
-            trial_id,
-            event_name
-        )
-        rel_frame = rel_frames[i_frame]
-
-        frame = self.image_repo.get_frame(subject_id,
-                                          trial_id,
-                                          event_name,
-                                          rel_frame
-                                          )
-        return True if frame else False
-
     def next_point(self):
-        limit = 1000
-        i = 0
-        while i < limit:
-            i += 1
-
-            # probe next
-            i_frame, i_event, i_kp, i_cam = self._probe_frame()
-
-            if self.has_frame(self.subject_id, self.trial_id, i_event, i_frame):
-                break
-
-        if i == limit:
+        if not self._n_positions:
             raise Exception("Next frame not found")
 
-        # log update point...
-        print(" * [next point] frame found, event: %s/%i, frame: %i" % (self.event_names[i_event],
-                                                                        i_event,
-                                                                        i_frame))
+        i_frame, i_event, i_kp, i_cam = self._next_position()
 
         # 1) progress frame
         self.i_frame = i_frame
         self.i_event = i_event
         self.i_kp = i_kp
         self.i_cam = i_cam
-        print("   - Progress")
-        print("      - to frame:", self.i_frame)
-        print("      - to event:", self.event_names[self.i_event], i_event)
-        print("      - to landmark:", self.avail_landmarks[self.i_kp])
-        print("      - to camera:", self.cam_ids[self.i_cam])
 
-    def load_image(self, path1, path2):
-        image1 = plt.imread(path1)
-        image2 = plt.imread(path2)
+        logger.debug("next point: event %s/%i, frame %i, landmark %s, camera %s",
+                     self.event_names[i_event], i_event, i_frame,
+                     self.avail_landmarks[i_kp], self.cam_ids[i_cam])
 
-        if self.im1 is None:
-            self.im1 = self.ax1.imshow(image1, interpolation="none")
-        else:
-            self.im1.set_array(image1)
+    def _get_or_submit(self, path):
+        future = self._img_cache.get(path)
+
+        # retry failed reads, the file may have been missing or half written
+        if future is not None and future.done() and future.exception() is not None:
+            del self._img_cache[path]
+            future = None
 
-        if self.im2 is None:
-            self.im2 = self.ax2.imshow(image2, interpolation="none")
+        if future is None:
+            future = self._pool.submit(read_image, path, self.image_max_width)
+            self._img_cache[path] = future
         else:
-            self.im2.set_array(image2)
+            self._img_cache.move_to_end(path)
+
+        while len(self._img_cache) > self.image_cache_size:
+            self._img_cache.popitem(last=False)
+
+        return future
+
+    def _prefetch_neighbors(self):
+        # previous and next frame of the event, and the next point
+        n_frames = len(self._rel_frames())
+        i_frame, i_event, _, i_cam = self._next_position()
+        positions = [
+            (self.i_event, (self.i_frame + 1) % n_frames, self.i_cam),
+            (self.i_event, (self.i_frame - 1) % n_frames, self.i_cam),
+            (i_event, i_frame, i_cam),
+        ]
+
+        for position in positions:
+            for path in self._image_paths_at(*position) or []:
+                self._get_or_submit(path)
+
+    def load_image(self, path1, path2):
+        fut1, fut2 = self._get_or_submit(path1), self._get_or_submit(path2)
+        self.im1 = self._show_image(self.ax1, self.im1, *fut1.result())
+        self.im2 = self._show_image(self.ax2, self.im2, *fut2.result())
+
+        self._last_paths = (path1, path2)
+
+    def _show_image(self, ax, im, image, factor):
+        # extent in full resolution pixels, markers are stored in those
+        height, width = image.shape[:2]
+        extent = (-0.5, width * factor - 0.5, height * factor - 0.5, -0.5)
+
+        if im is None:
+            return ax.imshow(image, interpolation="none", extent=extent)
+
+        im.set_array(image)
+        if tuple(im.get_extent()) != extent:
+            im.set_extent(extent)
+        return im
 
 
 parser = argparse.ArgumentParser()
@@ -562,11 +763,15 @@ parser.add_argument("--trial", "-T",
 
 if __name__ == "__main__":
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # blitting and the crosshair cursor rely on the Tk canvas
+    plt.switch_backend("TkAgg")
     db_path = args.db
     frame_path = args.input
 
     print(" * Opening frame image log: %s" % (args.input,))
-    image_repo = ImageRepo(frame_path)
+    image_repo = ImageRepo(frame_path, prefetch=False)
     print(" * Opening label database: %s" % (db_path,))
     repo = SQLiteLabelRepo(db_path)
 